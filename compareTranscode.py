@@ -6,6 +6,8 @@ import dill
 import imutils
 import numpy as np
 import os
+import re
+import shlex
 from skimage.metrics import structural_similarity
 import subprocess
 import sys
@@ -13,7 +15,7 @@ import sys
 # Verify script is colocated with ./lib/ and import dependencies
 sys.path.append(os.path.join(sys.path[0], "lib"))
 try:
-	from common import get_choice_from_menu
+	from common import get_choice_from_menu, get_frame_index, get_frame_tolerance, get_sample_points
 except ImportError:
 	sys.exit("FATAL: failed to import dependencies from ./lib/\n")
 
@@ -46,41 +48,81 @@ else:
 
 print("\nComparison frames:\t{frames}".format(frames=args.num_frames))
 
+# Keyframe/timestamp indexes are cached alongside comparison output and rebuilt when a file changes
+index_directory = os.path.join(os.path.relpath("comparison"), ".index")
+
+def read_frame_at(file_path, timestamp, tolerance, keyframe):
+	"""	Decodes the frame at timestamp (seconds from start of stream) from file_path with ffmpeg input seeking,
+		returns None if no frame within tolerance of timestamp is decoded
+	"""
+	def decode(seek_options, seek_time):
+		cmd = "ffmpeg -hide_banner -loglevel info {options} -ss {time:.6f} -i {path} -map 0:v:0 -frames:v 1 -vf showinfo -f image2pipe -vcodec png -".format(options=seek_options, time=max(seek_time, 0), path=shlex.quote(file_path))
+		result = subprocess.run(shlex.split(cmd), capture_output=True)
+		match = re.search(r"pts_time:\s*(-?[\d.]+)", result.stderr.decode("utf-8", "replace"))
+		if result.returncode != 0 or not result.stdout or not match:
+			return None, None
+		# Output timestamps are shifted by the seek position unless -copyts is used
+		return cv2.imdecode(np.frombuffer(result.stdout, np.uint8), cv2.IMREAD_COLOR), max(seek_time, 0) + float(match.group(1))
+
+	if keyframe:
+		# Seeking just past a keyframe lands the demuxer on it, so decoding starts there with no pre-roll
+		frame, position = decode("-noaccurate_seek", timestamp + tolerance / 2)
+		if frame is not None and abs(position - timestamp) <= tolerance:
+			return frame
+
+	# Frame-accurate seek decodes forward from the preceding keyframe and drops frames before the seek point
+	frame, position = decode("", timestamp - tolerance / 2)
+	if frame is not None and abs(position - timestamp) <= tolerance:
+		return frame
+
+	return None
+
 for source_file in source_files:
 	source_file_path = os.path.join("source", source_file)
 	source_file_size = int(os.path.getsize(source_file_path)/1000000)
-	source_file_handle = cv2.VideoCapture(source_file_path)
+	source_index = get_frame_index(source_file_path, index_directory)
 	hevc_files = [filename for filename in os.listdir("hevc") if filename.startswith(os.path.splitext(source_file)[0])]
 
 	for hevc_file in hevc_files:
 		evaluate_frames = True
 		output_directory = os.path.join(os.path.relpath("comparison"), os.path.splitext(os.path.basename(hevc_file))[0])
 		hevc_file_path = os.path.join("hevc", hevc_file)
-		hevc_file_handle = cv2.VideoCapture(hevc_file_path)
 		hevc_file_size = int(os.path.getsize(hevc_file_path)/1000000)
 		compression_ratio = int(100-(hevc_file_size/source_file_size*100))
-		total_frames = source_file_handle.get(cv2.CAP_PROP_FRAME_COUNT)
-		# get other attributes from ./performance/<<>>.log
-		stride = int(total_frames/(args.num_frames+1))
+		hevc_index = get_frame_index(hevc_file_path, index_directory)
+		# Frames are paired by presentation timestamp, allow up to half a frame of drift between source and HEVC
+		source_tolerance = get_frame_tolerance(source_index)
+		tolerance = get_frame_tolerance(hevc_index)
+		sample_points = get_sample_points(source_index, hevc_index, args.num_frames)
 
 		print("\nFilename:\t\t{filename}".format(filename=hevc_file))
-		if source_file_handle.get(cv2.CAP_PROP_FRAME_COUNT) != hevc_file_handle.get(cv2.CAP_PROP_FRAME_COUNT):
-			print("\t\t\t!!! WARNING: Frame counts do not match, screencaps may be time-shifted")
-			evaluate_frames = False
+		if len(source_index["timestamps"]) != len(hevc_index["timestamps"]):
+			print("\t\t\t!!! WARNING: Frame counts do not match, pairing frames by timestamp")
 		print("\tSource Size:\t{size} MB".format(size=source_file_size))
 		print("\tHEVC Size:\t{size} MB".format(size=hevc_file_size))
 		print("\tReduction:\t{ratio}%\n".format(ratio=compression_ratio))
+		if len(sample_points) < args.num_frames:
+			print("\t!!! WARNING: only {count} of {num_frames} comparison frames could be placed\n".format(count=len(sample_points), num_frames=args.num_frames))
 
 		ssim_total = 0.0
 		ssim_values = {}
 		print("\tSSIM:")
 		if not os.path.exists(output_directory): os.makedirs(output_directory)
+		# Remove screenshots from a previous run so evaluate.py only scores the pairs written below
+		for screenshot in [file for file in os.listdir(output_directory) if file.endswith("-source.png") or file.endswith("-x265.png")]:
+			os.remove(os.path.join(output_directory, screenshot))
 		#if frame_resolution_differs: # e.g. letterboxing removed -- where does this go?
-		for frame in range(1, args.num_frames+1):
-			source_file_handle.set(cv2.CAP_PROP_POS_FRAMES,stride*frame)
-			hevc_file_handle.set(cv2.CAP_PROP_POS_FRAMES,stride*frame)
-			ret,source_frame = source_file_handle.read()
-			ret,hevc_frame = hevc_file_handle.read()
+		frame = 0
+		for source_time, source_keyframe, hevc_time, hevc_keyframe in sample_points:
+			if abs(hevc_time - source_time) > tolerance:
+				print("\t {time:.3f}s:\tskipped, no HEVC frame within {tolerance:.3f}s".format(time=source_time, tolerance=tolerance))
+				continue
+			source_frame = read_frame_at(source_file_path, source_time, source_tolerance, source_keyframe)
+			hevc_frame = read_frame_at(hevc_file_path, hevc_time, tolerance, hevc_keyframe)
+			if source_frame is None or hevc_frame is None:
+				print("\t {time:.3f}s:\tskipped, could not decode frame at timestamp".format(time=source_time))
+				continue
+			frame += 1
 			cv2.imwrite(os.path.join(output_directory, "{number}-source.png".format(number=frame)), source_frame, [cv2.IMWRITE_PNG_COMPRESSION, 0])
 			cv2.imwrite(os.path.join(output_directory, "{number}-x265.png".format(number=frame)), hevc_frame, [cv2.IMWRITE_PNG_COMPRESSION, 0])
 			if evaluate_frames:
@@ -94,7 +136,7 @@ for source_file in source_files:
 					ssim_total += ssim
 					print("\t Frame {frame}:\t{ssim}".format(frame=frame, ssim=ssim))
 
-		ssim_average = ssim_total/args.num_frames
+		ssim_average = ssim_total/len(ssim_values) if ssim_values else 0.0
 		print("\tAverage:\t{average}\n".format(average=ssim_average))
 		with open(os.path.join("performance", hevc_file[:-4] + ".log"), "r") as performance_file:
 			duration = performance_file.readline().rstrip()
@@ -102,11 +144,7 @@ for source_file in source_files:
 		with open(os.path.join(output_directory, "summary.txt"), "w") as summary_file:
 			summary_file.write("SSIM Avg:\t{average}\nDuration:\t{duration}\nFPS:\t\t{fps}\nCompression:\t{compression}%\n\n".format(average=ssim_average, duration=duration, fps=fps, compression=compression_ratio))
 			if evaluate_frames:
-				for iterator in range(1, args.num_frames+1):
+				for iterator in sorted(ssim_values):
 					summary_file.write("\t{iterator}:\t{ssim}\n".format(iterator=iterator, ssim=ssim_values[iterator]))
 
-		hevc_file_handle.release()
-
-	source_file_handle.release()
-
 sys.exit("Done.\n")
\ No newline at end of file
@@ -1,11 +1,13 @@
 #!/usr/local/bin/python3
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import cv2
 import imutils
 import os
 from skimage.metrics import structural_similarity
 import sys
+import tempfile
 
 sys.path.append(os.path.join(sys.path[0], "lib"))
 try:
@@ -13,81 +15,191 @@ try:
 except ImportError:
 	sys.exit("FATAL: failed to import dependencies from ./lib/\n")
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--dir")
-parser.add_argument("--frame")
-args = parser.parse_args()
+def evaluate_args():
+	"""	Exits with error messages if command-line arguments are invalid
+	"""
+	parser = argparse.ArgumentParser()
+	dir_group = parser.add_mutually_exclusive_group()
+	dir_group.add_argument("--dir")
+	dir_group.add_argument("--all", action="store_true", help="evaluate every comparison directory that is pending or out of date")
+	parser.add_argument("--frame")
+	parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes used to compute SSIM")
+	args = parser.parse_args()
 
-if not args.dir:
-	choices = sorted([file for file in os.listdir("comparison") if os.path.isdir(os.path.join("comparison", file))])
-	if len(choices) == 0:
-		sys.exit("\nNo transcode directories to evaluate.\n")
-	else:
-		print("\nChoose a transcode to evaluate:")
-		transcode = choices[get_choice_from_menu(choices)]
-else:
-	if args.dir in os.listdir("comparison"):
-		transcode = args.dir
-	else:
-		sys.exit("Invalid directory.\n")
-
-# TODO: frame arg
-
-screenshots = sorted([file for file in os.listdir(os.path.join("comparison", transcode)) if file.endswith(".png")], key=lambda filename: int(filename.split("-")[0]))
-
-if not (len(screenshots) % 2 == 0):
-	sys.exit("ERROR: Odd number of screenshots found in {directory}".format(directory=transcode))
-else:
-	num_screenshots = int(len(screenshots)/2)
-
-
-#TODO: integrate into compareEncoding.py, error out if source/hevc dimenions !=
-
-if os.path.exists(os.path.join("comparison", transcode, "summary.txt")):
-	sys.exit("\nsummary.txt exists, {transcode} has already been evaluated.\n\nExiting.\n".format(transcode=transcode))
-
-file_info = {"filename": transcode}
-with open(os.path.join("performance", transcode + ".log"), "r") as log_file:
-	file_info["duration"] = log_file.readline().rstrip()
-	file_info["fps"] = "{:0.2f}".format(float(log_file.readline().rstrip().split(" ")[0]))
-	file_info["compression"] = log_file.readline().rstrip().split(" ")[0]
-	for line in log_file:
-		if "bitrate" in line:
-			file_info["bitrate"] = int(line.rstrip().split(": ")[2][:-1])
-		elif "height" in line:
-			file_info["height"] = line.rstrip().split(": ")[1][:-1]
-		elif "width" in line:
-			file_info["width"] = line.rstrip().split(": ")[1][:-2]
-		elif "encoder_quality" in line:
-			file_info["encoder_quality"] = line.rstrip().split(": ")[1][:-1]
-		elif "encoder_preset" in line:
-			file_info["encoder_preset"] = line.rstrip().split(": ")[1][1:-2]
-		elif "encoder_options" in line:
-			file_info["encoder_options"] = line.rstrip().split(": ")[1][1:-2]
-
-print(" Resolution:\t{resolution}".format(resolution=file_info["width"] + "x" + file_info["height"]))
-print(" Bitrate:\t{bitrate}".format(bitrate=str(int(file_info["bitrate"] / 1000)) + "kbps"))
-print(" Encoder:\t{settings}".format(settings=str("RF" + file_info["encoder_quality"] + " " + file_info["encoder_preset"] + ", " + file_info["encoder_options"])))
-print(" Duration:\t{duration}".format(duration=file_info["duration"]))
-print(" FPS:\t\t{fps}".format(fps=str(file_info["fps"])))
-print(" Compression:\t{ratio}".format(ratio=file_info["compression"]))
-
-print("\n SSIM:")
-ssim_total = 0.0
-ssim_values = {}
-for image_iterator in range(1, num_screenshots+1):
-	screenshot_pair = sorted([os.path.join("comparison", transcode, screenshot) for screenshot in screenshots if screenshot.split("-")[0] == str(image_iterator)])
-	ssim = structural_similarity(cv2.cvtColor(cv2.imread(screenshot_pair[0]), cv2.COLOR_BGR2GRAY), cv2.cvtColor(cv2.imread(screenshot_pair[1]), cv2.COLOR_BGR2GRAY))
+	if not os.path.isdir("comparison"):
+		sys.exit("Invalid working directory, exiting.")
+	elif args.jobs < 1:
+		sys.exit("--jobs must be at least 1.\n")
+
+	return args
+
+def get_screenshots(transcode):
+	"""	Returns sorted list of screenshots in comparison directory for transcode
+	"""
+	screenshots = sorted([file for file in os.listdir(os.path.join("comparison", transcode)) if file.endswith(".png")], key=lambda filename: int(filename.split("-")[0]))
+
+	if len(screenshots) == 0:
+		raise ValueError("No screenshots found in {directory}".format(directory=transcode))
+	elif not (len(screenshots) % 2 == 0):
+		raise ValueError("Odd number of screenshots found in {directory}".format(directory=transcode))
+
+	return screenshots
+
+def is_pending(transcode):
+	"""	Returns True if transcode has no summary.txt or if its screenshots or performance log are newer than summary.txt
+	"""
+	summary_path = os.path.join("comparison", transcode, "summary.txt")
+	if not os.path.exists(summary_path):
+		return True
+
+	inputs = [os.path.join("comparison", transcode, file) for file in os.listdir(os.path.join("comparison", transcode)) if file.endswith(".png")]
+	log_path = os.path.join("performance", transcode + ".log")
+	if os.path.exists(log_path):
+		inputs.append(log_path)
+
+	return any(os.path.getmtime(path) > os.path.getmtime(summary_path) for path in inputs)
+
+def read_log(transcode):
+	"""	Parses ./performance/<transcode>.log and returns dictionary of file info
+	"""
+	file_info = {"filename": transcode}
+	with open(os.path.join("performance", transcode + ".log"), "r") as log_file:
+		file_info["duration"] = log_file.readline().rstrip()
+		file_info["fps"] = "{:0.2f}".format(float(log_file.readline().rstrip().split(" ")[0]))
+		file_info["compression"] = log_file.readline().rstrip().split(" ")[0]
+		for line in log_file:
+			if "bitrate" in line:
+				file_info["bitrate"] = int(line.rstrip().split(": ")[2][:-1])
+			elif "height" in line:
+				file_info["height"] = line.rstrip().split(": ")[1][:-1]
+			elif "width" in line:
+				file_info["width"] = line.rstrip().split(": ")[1][:-2]
+			elif "encoder_quality" in line:
+				file_info["encoder_quality"] = line.rstrip().split(": ")[1][:-1]
+			elif "encoder_preset" in line:
+				file_info["encoder_preset"] = line.rstrip().split(": ")[1][1:-2]
+			elif "encoder_options" in line:
+				file_info["encoder_options"] = line.rstrip().split(": ")[1][1:-2]
+
+	return file_info
+
+# Per-directory failures: bad screenshot counts, SSIM on mismatched dimensions, unreadable images, incomplete logs
+evaluation_errors = (ValueError, KeyError, IndexError, OSError, cv2.error)
+
+def compute_ssim(screenshot_pair):
+	"""	Returns SSIM for (source, hevc) screenshot pair, run in worker processes
+	"""
+	return structural_similarity(cv2.cvtColor(cv2.imread(screenshot_pair[0]), cv2.COLOR_BGR2GRAY), cv2.cvtColor(cv2.imread(screenshot_pair[1]), cv2.COLOR_BGR2GRAY))
 	#(score, diff) = structural_similarity(source_grayscale, hevc_grayscale, full=True)
 	# What does the full image get me?
-	ssim_values[image_iterator] = ssim
-	print("  Frame {image_iterator}:\t{ssim}".format(image_iterator=image_iterator, ssim=ssim))
-	ssim_total += ssim
 
-ssim_average = ssim_total/num_screenshots
-print(" Average:\t{average}\n".format(average=ssim_average))
+def submit_transcode(executor, transcode):
+	"""	Submits every screenshot pair in transcode to executor and returns dictionary of futures keyed by frame number
+	"""
+	screenshots = get_screenshots(transcode)
+	futures = {}
+	for image_iterator in range(1, int(len(screenshots)/2)+1):
+		screenshot_pair = sorted([os.path.join("comparison", transcode, screenshot) for screenshot in screenshots if screenshot.split("-")[0] == str(image_iterator)])
+		futures[image_iterator] = executor.submit(compute_ssim, screenshot_pair)
+
+	return futures
+
+def write_summary(transcode, file_info, ssim_values):
+	"""	Prints evaluation for transcode and atomically writes summary.txt
+	"""
+	print("\n{transcode}".format(transcode=transcode))
+	print(" Resolution:\t{resolution}".format(resolution=file_info["width"] + "x" + file_info["height"]))
+	print(" Bitrate:\t{bitrate}".format(bitrate=str(int(file_info["bitrate"] / 1000)) + "kbps"))
+	print(" Encoder:\t{settings}".format(settings=str("RF" + file_info["encoder_quality"] + " " + file_info["encoder_preset"] + ", " + file_info["encoder_options"])))
+	print(" Duration:\t{duration}".format(duration=file_info["duration"]))
+	print(" FPS:\t\t{fps}".format(fps=str(file_info["fps"])))
+	print(" Compression:\t{ratio}".format(ratio=file_info["compression"]))
+
+	print("\n SSIM:")
+	for image_iterator, ssim in sorted(ssim_values.items()):
+		print("  Frame {image_iterator}:\t{ssim}".format(image_iterator=image_iterator, ssim=ssim))
+
+	ssim_average = sum(ssim_values.values())/len(ssim_values) if ssim_values else 0.0
+	print(" Average:\t{average}\n".format(average=ssim_average))
+
+	# Write to a temporary file and rename so an interrupted run never leaves a partial summary.txt
+	summary_path = os.path.join("comparison", transcode, "summary.txt")
+	file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(summary_path), prefix=".summary-", suffix=".tmp")
+	try:
+		with os.fdopen(file_descriptor, "w") as summary_file:
+			summary_file.write("SSIM Avg:\t{average}\nDuration:\t{duration}\nFPS:\t\t{fps}\nCompression:\t{compression}\n\n".format(average=ssim_average, duration=file_info["duration"], fps=file_info["fps"], compression=file_info["compression"]))
+			for iterator, ssim in sorted(ssim_values.items()):
+				summary_file.write("\t{iterator}:\t{ssim}\n".format(iterator=iterator, ssim=ssim))
+		# mkstemp creates 0600 files, apply the umask as open() would have
+		umask = os.umask(0)
+		os.umask(umask)
+		os.chmod(temp_path, 0o666 & ~umask)
+		os.replace(temp_path, summary_path)
+	except BaseException:
+		os.remove(temp_path)
+		raise
+
+def report_failure(args, transcode, error):
+	"""	Exits for a single transcode, otherwise reports error so the rest of an --all batch can continue
+	"""
+	if not args.all:
+		sys.exit("ERROR: {transcode}: {error}\n".format(transcode=transcode, error=repr(error)))
+
+	print("\nERROR: skipping {transcode}: {error}".format(transcode=transcode, error=repr(error)))
+	return transcode
+
+def main():
+	args = evaluate_args()
+
+	if args.all:
+		transcodes = [directory for directory in sorted(os.listdir("comparison")) if os.path.isdir(os.path.join("comparison", directory)) and not directory.startswith(".")]
+		for transcode in [transcode for transcode in transcodes if not os.path.exists(os.path.join("performance", transcode + ".log"))]:
+			print("Skipping {transcode}: no performance log".format(transcode=transcode))
+		transcodes = [transcode for transcode in transcodes if os.path.exists(os.path.join("performance", transcode + ".log")) and is_pending(transcode)]
+		if len(transcodes) == 0:
+			sys.exit("\nAll transcode directories are up to date.\n")
+		print("\nEvaluating {count} transcode directories with {jobs} workers...".format(count=len(transcodes), jobs=args.jobs))
+	elif not args.dir:
+		choices = sorted([file for file in os.listdir("comparison") if os.path.isdir(os.path.join("comparison", file)) and not file.startswith(".")])
+		if len(choices) == 0:
+			sys.exit("\nNo transcode directories to evaluate.\n")
+		else:
+			print("\nChoose a transcode to evaluate:")
+			transcodes = [choices[get_choice_from_menu(choices)]]
+	else:
+		if args.dir in os.listdir("comparison"):
+			transcodes = [args.dir]
+		else:
+			sys.exit("Invalid directory.\n")
+
+	# TODO: frame arg
+
+	#TODO: integrate into compareEncoding.py, error out if source/hevc dimenions !=
+
+	if not args.all and not is_pending(transcodes[0]):
+		sys.exit("\nsummary.txt is up to date, {transcode} has already been evaluated.\n\nExiting.\n".format(transcode=transcodes[0]))
+
+	# Frame pairs from every directory share one pool, summaries are written as each directory completes
+	failed = []
+	with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+		pending = []
+		for transcode in transcodes:
+			try:
+				pending.append((transcode, read_log(transcode), submit_transcode(executor, transcode)))
+			except evaluation_errors as error:
+				failed.append(report_failure(args, transcode, error))
+
+		for transcode, file_info, futures in pending:
+			try:
+				ssim_values = {image_iterator: future.result() for image_iterator, future in futures.items()}
+				write_summary(transcode, file_info, ssim_values)
+			except evaluation_errors as error:
+				for future in futures.values():
+					future.cancel()
+				failed.append(report_failure(args, transcode, error))
+
+	if failed:
+		sys.exit("\nFailed to evaluate {count} transcode directories: {transcodes}\n".format(count=len(failed), transcodes=", ".join(failed)))
 
-with open(os.path.join("comparison", transcode, "summary.txt"), "w") as summary_file:
-	summary_file.write("SSIM Avg:\t{average}\nDuration:\t{duration}\nFPS:\t\t{fps}\nCompression:\t{compression}\n\n".format(average=ssim_average, duration=file_info["duration"], fps=file_info["fps"], compression=file_info["compression"]))
-	for iterator in range(1, num_screenshots+1):
-		summary_file.write("\t{iterator}:\t{ssim}\n".format(iterator=iterator, ssim=ssim_values[iterator]))
\ No newline at end of file
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,189 @@
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import sys
+import threading
+
+class Metrics():
+
+	#	HandBrakeCLI progress line, e.g. "Encoding: task 1 of 1, 12.34 % (45.67 fps, avg 40.12 fps, ETA 00h01m02s)"
+	progress_pattern = re.compile(r"Encoding: task \d+ of \d+, ([\d.]+) %(?: \(([\d.]+) fps, avg ([\d.]+) fps, ETA (\d+)h(\d+)m(\d+)s\))?")
+
+	#	Object lifecycle methods
+
+	def __init__(self, port=None, event_log=None):
+		self.lock = threading.Lock()
+		self.queue_depth = 0
+		self.jobs = {}
+		self.counters = {"completed": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+		self.stages = {stage: {"count": 0, "sum": 0.0} for stage in ("probe", "encode", "finish")}
+		self.last_compression_ratio = {}
+
+		try:
+			self.event_log = open(event_log, "a") if event_log else None
+		except OSError as error:
+			sys.exit("FATAL: unable to open event log {path}: {error}\n".format(path=event_log, error=error.strerror))
+
+		if port is not None:
+			try:
+				self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+			except OSError as error:
+				sys.exit("FATAL: unable to serve metrics on port {port}: {error}\n".format(port=port, error=error.strerror))
+			threading.Thread(target=self.server.serve_forever, daemon=True).start()
+			print("Serving metrics on http://127.0.0.1:{port}/metrics".format(port=port))
+		else:
+			self.server = None
+
+	def close(self):
+		"""	Stops metrics endpoint and closes event log
+		"""
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
+		if self.event_log:
+			self.event_log.close()
+
+	@property
+	def enabled(self):
+		return self.server is not None or self.event_log is not None
+
+	#	Object task methods
+
+	def event(self, name, **fields):
+		"""	Appends JSON-lines record to event log
+		"""
+		if not self.event_log:
+			return
+		record = {"time": datetime.now().isoformat(), "event": name}
+		record.update(fields)
+		with self.lock:
+			self.event_log.write(json.dumps(record, default=str) + "\n")
+			self.event_log.flush()
+
+	def set_queue_depth(self, depth):
+		with self.lock:
+			self.queue_depth = depth
+		self.event("queue", depth=depth)
+
+	def stage(self, source, stage, seconds):
+		"""	Records latency for probe, encode or finish stage of a transcode
+		"""
+		with self.lock:
+			self.stages[stage]["count"] += 1
+			self.stages[stage]["sum"] += seconds
+		self.event("stage", source=source, stage=stage, seconds=seconds)
+
+	def job_started(self, source, bytes_in):
+		with self.lock:
+			self.jobs[source] = {"progress": 0.0, "fps": 0.0, "eta": None}
+			self.counters["bytes_in"] += bytes_in
+		self.event("job_started", source=source, bytes_in=bytes_in)
+
+	def job_progress(self, source, progress, fps=None, eta=None):
+		with self.lock:
+			job = self.jobs.get(source)
+			if job is None:
+				return
+			job["progress"] = progress
+			if fps is not None:
+				job["fps"] = fps
+				job["eta"] = eta
+
+	def job_finished(self, source, bytes_out, compression_ratio):
+		with self.lock:
+			self.jobs.pop(source, None)
+			self.counters["completed"] += 1
+			self.counters["bytes_out"] += bytes_out
+			self.last_compression_ratio[source] = compression_ratio
+		self.event("job_finished", source=source, bytes_out=bytes_out, compression_ratio=compression_ratio)
+
+	def job_failed(self, source, reason):
+		with self.lock:
+			self.jobs.pop(source, None)
+			self.counters["failed"] += 1
+		self.event("job_failed", source=source, reason=reason)
+
+	def watch(self, source, stream):
+		"""	Echoes HandBrakeCLI output to console while parsing progress lines, returns reader thread
+		"""
+		def reader():
+			buffer = b""
+			for chunk in iter(lambda: stream.read1(4096), b""):
+				sys.stdout.buffer.write(chunk)
+				sys.stdout.buffer.flush()
+				buffer += chunk
+				# HandBrakeCLI redraws progress with carriage returns rather than newlines
+				*lines, buffer = re.split(rb"[\r\n]", buffer)
+				for line in lines:
+					match = self.progress_pattern.search(line.decode("utf-8", "replace"))
+					if match:
+						progress, fps, avg_fps, hours, minutes, seconds = match.groups()
+						eta = int(hours) * 3600 + int(minutes) * 60 + int(seconds) if fps else None
+						self.job_progress(source, float(progress), float(fps) if fps else None, eta)
+			stream.close()
+
+		thread = threading.Thread(target=reader, daemon=True)
+		thread.start()
+		return thread
+
+	def render(self):
+		"""	Returns current metrics in Prometheus text exposition format
+		"""
+		def escape(value):
+			return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+		with self.lock:
+			lines = [
+					"# HELP transcode_queue_depth Source files waiting to be transcoded",
+					"# TYPE transcode_queue_depth gauge",
+					"transcode_queue_depth {value}".format(value=self.queue_depth),
+					"# HELP transcode_active_jobs HandBrakeCLI jobs currently running",
+					"# TYPE transcode_active_jobs gauge",
+					"transcode_active_jobs {value}".format(value=len(self.jobs))
+				]
+			for name, help_text in (("completed", "Transcodes finished successfully"), ("failed", "Transcodes that failed"), ("bytes_in", "Source bytes submitted for transcoding"), ("bytes_out", "HEVC bytes written")):
+				lines += [
+						"# HELP transcode_{name}_total {help_text}".format(name=name, help_text=help_text),
+						"# TYPE transcode_{name}_total counter".format(name=name),
+						"transcode_{name}_total {value}".format(name=name, value=self.counters[name])
+					]
+			lines += ["# HELP transcode_job_progress_percent Encode progress of running job", "# TYPE transcode_job_progress_percent gauge"]
+			lines += ["transcode_job_progress_percent{{source=\"{source}\"}} {value}".format(source=escape(source), value=job["progress"]) for source, job in self.jobs.items()]
+			lines += ["# HELP transcode_job_fps Current encode speed of running job", "# TYPE transcode_job_fps gauge"]
+			lines += ["transcode_job_fps{{source=\"{source}\"}} {value}".format(source=escape(source), value=job["fps"]) for source, job in self.jobs.items()]
+			lines += ["# HELP transcode_job_eta_seconds Estimated time remaining for running job", "# TYPE transcode_job_eta_seconds gauge"]
+			lines += ["transcode_job_eta_seconds{{source=\"{source}\"}} {value}".format(source=escape(source), value=job["eta"]) for source, job in self.jobs.items() if job["eta"] is not None]
+			lines += ["# HELP transcode_compression_ratio_percent Size reduction of finished transcode", "# TYPE transcode_compression_ratio_percent gauge"]
+			lines += ["transcode_compression_ratio_percent{{source=\"{source}\"}} {value}".format(source=escape(source), value=ratio) for source, ratio in self.last_compression_ratio.items()]
+			lines += ["# HELP transcode_stage_seconds Latency of probe, encode and finish stages", "# TYPE transcode_stage_seconds summary"]
+			for stage, values in self.stages.items():
+				lines.append("transcode_stage_seconds_sum{{stage=\"{stage}\"}} {value}".format(stage=stage, value=values["sum"]))
+				lines.append("transcode_stage_seconds_count{{stage=\"{stage}\"}} {value}".format(stage=stage, value=values["count"]))
+
+		return "\n".join(lines) + "\n"
+
+	def handler(self):
+		"""	Returns request handler class bound to this Metrics instance
+		"""
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path != "/metrics":
+					self.send_error(404)
+					return
+				body = metrics.render().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		return Handler
+
+if __name__ == "__main__":
+	sys.exit("I am a module, not a script.")
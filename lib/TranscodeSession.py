@@ -114,14 +114,15 @@ class Session():
 		if any(value is None for attribute, value in self.__dict__.items()):
 			sys.exit("FATAL: Session.validate(): found null attribute for " + self.path["source"])
 
-	def start(self):
-		"""	Starts HandBrakeCLI session and creates job attribute
+	def start(self, stdout=None):
+		"""	Starts HandBrakeCLI session and creates job attribute, optionally capturing HandBrakeCLI output
 		"""
+		signal.signal(signal.SIGINT, self.signal_handler) # Sessions are built up front, make sure ctrl+c reaches the running job
 		print("{date}: Starting transcode session for {source}:".format(date=str(datetime.now()), source=self.path["source"]))
 		pprint(vars(self), indent=4)
 		print("\n{command}\n".format(command=self.command))
 		self.time = {"started": datetime.now()}
-		self.job = subprocess.Popen(shlex.split(self.command, posix=False)) # Posix=False to escape double-quotes in arguments
+		self.job = subprocess.Popen(shlex.split(self.command, posix=False), stdout=stdout) # Posix=False to escape double-quotes in arguments
 
 	def finish(self):
 		"""	Compute attributes needed to generate summary and performance log
@@ -1,3 +1,11 @@
+from bisect import bisect_left
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+
 def get_yn_answer():
 	"""	Accepts yes/no answer as user input and returns answer as boolean
 	"""
@@ -38,5 +46,108 @@ def get_choice_from_menu(choices):
 
 	return user_input-1
 
+def get_frame_index(file_path, cache_directory):
+	"""	Returns presentation timestamps and keyframe timestamps for the first video stream in file_path,
+		read from a cached ffprobe packet index in cache_directory if it is still current
+	"""
+	# Key by relative path so source/ and hevc/ files sharing a basename don't overwrite each other
+	cache_path = os.path.join(cache_directory, os.path.relpath(file_path).replace(os.sep, "_") + ".json")
+	file_stat = os.stat(file_path)
+
+	if os.path.exists(cache_path):
+		# Unreadable or outdated cache formats are rebuilt below
+		try:
+			with open(cache_path, "r") as cache_file:
+				index = json.load(cache_file)
+			if index["filesize"] == file_stat.st_size and index["mtime"] == file_stat.st_mtime and all(key in index for key in ("start", "timestamps", "keyframes")):
+				return index
+		except (ValueError, KeyError, TypeError):
+			pass
+
+	cmd = "ffprobe -v quiet -select_streams v:0 -show_entries packet=pts_time,flags -print_format json " + shlex.quote(file_path)
+	packets = json.loads(subprocess.check_output(shlex.split(cmd)).decode("utf-8"))["packets"]
+	packets = [packet for packet in packets if packet.get("pts_time", "N/A") != "N/A"]
+
+	# Packets are in decode order, frame positions are in presentation order
+	timestamps = sorted(float(packet["pts_time"]) for packet in packets)
+	keyframes = sorted(float(packet["pts_time"]) for packet in packets if "K" in packet.get("flags", ""))
+	index = {
+			"filesize": file_stat.st_size,
+			"mtime": file_stat.st_mtime,
+			"start": timestamps[0] if timestamps else 0.0,
+			"timestamps": timestamps,
+			"keyframes": keyframes
+		}
+
+	# Write to a temporary file and rename so an interrupted run never leaves a truncated cache
+	if not os.path.isdir(cache_directory):
+		os.makedirs(cache_directory)
+	file_descriptor, temp_path = tempfile.mkstemp(dir=cache_directory, prefix=".index-", suffix=".tmp")
+	try:
+		with os.fdopen(file_descriptor, "w") as cache_file:
+			json.dump(index, cache_file)
+		# mkstemp creates 0600 files, apply the umask as open() would have
+		umask = os.umask(0)
+		os.umask(umask)
+		os.chmod(temp_path, 0o666 & ~umask)
+		os.replace(temp_path, cache_path)
+	except BaseException:
+		os.remove(temp_path)
+		raise
+
+	return index
+
+def get_frame_tolerance(index):
+	"""	Returns half the average frame interval of index in seconds, or 0.0 if index has no timestamps
+	"""
+	if len(index["timestamps"]) < 2:
+		return 0.0
+
+	return (index["timestamps"][-1] - index["start"]) / (len(index["timestamps"]) - 1) / 2
+
+def get_sample_points(source_index, hevc_index, num_frames):
+	"""	Returns list of (source time, source is keyframe, hevc time, hevc is keyframe) tuples, with times in seconds from
+		the start of each stream. Each sample is placed on a source keyframe at or after evenly spaced points in the
+		source, preferring keyframes that line up with an hevc keyframe (or on the source frame nearest the point if no
+		keyframe is free), and paired with the hevc frame nearest in presentation time
+	"""
+	source_times = [timestamp - source_index["start"] for timestamp in source_index["timestamps"]]
+	hevc_times = [timestamp - hevc_index["start"] for timestamp in hevc_index["timestamps"]]
+	keyframe_times = [timestamp - source_index["start"] for timestamp in source_index["keyframes"]]
+	hevc_keyframe_times = [timestamp - hevc_index["start"] for timestamp in hevc_index["keyframes"]]
+	if not source_times or not hevc_times:
+		return []
+	tolerance = get_frame_tolerance(hevc_index)
+
+	def nearest(times, target, exclude=()):
+		position = bisect_left(times, target)
+		candidates = sorted(times[max(position - 1, 0):position + 2], key=lambda time: abs(time - target))
+		return next((time for time in candidates if time not in exclude), None)
+
+	def is_aligned(keyframe):
+		hevc_keyframe = nearest(hevc_keyframe_times, keyframe)
+		return hevc_keyframe is not None and abs(hevc_keyframe - keyframe) <= tolerance
+
+	sample_points = []
+	taken = set()
+	stride = source_times[-1] / (num_frames + 1)
+	for sample in range(1, num_frames + 1):
+		target = stride * sample
+		# Both files can then be seeked straight to a keyframe without decoding a preceding GOP
+		candidates = [keyframe for keyframe in keyframe_times[bisect_left(keyframe_times, target):bisect_left(keyframe_times, target + stride)] if keyframe not in taken]
+		source_time = next((keyframe for keyframe in candidates if is_aligned(keyframe)), None)
+		if source_time is None:
+			position = bisect_left(keyframe_times, target)
+			source_time = keyframe_times[position] if position < len(keyframe_times) else None
+		if source_time is None or source_time in taken:
+			source_time = nearest(source_times, target, taken)
+			if source_time is None:
+				continue
+		taken.add(source_time)
+		hevc_time = nearest(hevc_times, source_time)
+		sample_points.append((source_time, source_time in keyframe_times, hevc_time, hevc_time in hevc_keyframe_times))
+
+	return sorted(sample_points)
+
 if __name__ == "__main__":
 	sys.exit("I am a module, not a script.")
\ No newline at end of file
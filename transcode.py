@@ -3,6 +3,7 @@
 import argparse
 from datetime import datetime
 import os
+import subprocess
 import sys
 
 # Verify script is colocated with ./lib/ and import dependencies
@@ -10,6 +11,7 @@ if not os.path.isdir(os.path.join(sys.path[0], "lib")):
 	sys.exit("FATAL: ./lib/ not present in parent diectory.\n")
 sys.path.append(os.path.join(sys.path[0], "lib"))
 try:
+	from TranscodeMetrics import Metrics
 	from TranscodeSession import Session
 	from common import get_yn_answer
 except ImportError:
@@ -29,6 +31,8 @@ def evaluate_args():
 	preset_group.add_argument("--best", action="store_true", help="use highest quality encoder options")
 	parser.add_argument("--small", action="store_true", help="use additional encoder options to minimize filesize at the expense of speed")
 	parser.add_argument("--delete", action="store_true", help="delete output files when complete/interrupted")
+	parser.add_argument("--metrics-port", type=int, help="serve Prometheus-style metrics on http://127.0.0.1:PORT/metrics")
+	parser.add_argument("--event-log", help="append JSON-lines transcode events to file")
 	args = parser.parse_args()
 
 	valid_arguments = False
@@ -43,6 +47,8 @@ def evaluate_args():
 		print("\nFATAL:", args.preset, "not valid!")
 	elif args.quality and not args.quality in range(-12, 51):
 		print("\nATAL: quality must be between -12 and 51 (lower is slower + higher quality)")
+	elif args.metrics_port is not None and not args.metrics_port in range(1, 65536):
+		print("\nFATAL: metrics port must be between 1 and 65535")
 	else:
 		valid_arguments = True
 
@@ -60,8 +66,8 @@ def evaluate_args():
 
 	return args
 
-def build_source_list(args):
-	"""	Constructs and returns list of source files
+def build_source_list(args, metrics):
+	"""	Probes source files and returns list of sessions for files that have not been transcoded yet
 	"""
 	extensions = [".mp4", ".m4v", ".mov", ".mkv", ".mpg", ".mpeg", ".avi", ".wmv", ".flv", ".webm", ".ts"]
 
@@ -75,35 +81,84 @@ def build_source_list(args):
 		else:
 			sys.exit("FATAL: " + args.file + " has invalid file extension!\n")
 
+	# Each file is probed once here and its session reused for the transcode
+	sessions = []
+	probe_failures = 0
 	for source_file in source_files:
-		session = Session(source_file, args)
+		time_stage_started = datetime.now()
+		try:
+			session = Session(source_file, args)
+		except Exception as error:
+			print(" Failed to probe {source}: {error}".format(source=source_file, error=repr(error)))
+			metrics.job_failed(source_file, "probe failed: {error}".format(error=repr(error)))
+			probe_failures += 1
+			continue
+		metrics.stage(source_file, "probe", (datetime.now() - time_stage_started).total_seconds())
 		if os.path.exists(session.path["output"]):
 			print(" Skipping", source_file)
-			source_files = [file for file in source_files if file is not source_file]
+		else:
+			sessions.append(session)
 
-	if len(source_files) == 0:
-		if args.all:
+	if len(sessions) == 0:
+		if probe_failures:
+			sys.exit("No remaining files could be probed. Exiting.\n")
+		elif args.all:
 			sys.exit("All supported files in ./source/ have already been transcoded. Exiting.\n")
 		else:
 			sys.exit("File exists. Exiting.")
 	else:
-		print(str(source_files) + "\n")
+		print(str([session.path["source"] for session in sessions]) + "\n")
 
-	return source_files
+	return sessions
 
 
 # CHECK IF FILE IS HEVC OR NOT!
 
 
+def transcode(session, metrics):
+	"""	Encodes and finishes a probed session, reporting each stage to metrics
+	"""
+	file = session.path["source"]
+	metrics.job_started(file, session.source["filesize"])
+	time_stage_started = datetime.now()
+	session.start(stdout=subprocess.PIPE if metrics.enabled else None)
+	if metrics.enabled:
+		metrics.watch(file, session.job.stdout).join()
+		session.job.stdout = None # Closed pipe, drop it so the session can be serialized in finish()
+	session.job.wait()
+	metrics.stage(file, "encode", (datetime.now() - time_stage_started).total_seconds())
+	if session.job.returncode != 0:
+		print("\n{date}: HandBrakeCLI exited with status {status} for {source}\n".format(date=str(datetime.now()), status=session.job.returncode, source=file))
+		metrics.job_failed(file, "HandBrakeCLI exited with status {status}".format(status=session.job.returncode))
+		session.cleanup()
+		return
+
+	time_stage_started = datetime.now()
+	session.finish()
+	metrics.stage(file, "finish", (datetime.now() - time_stage_started).total_seconds())
+	metrics.job_finished(file, session.output["filesize"], session.output["compression_ratio"])
+
 def main():
 	args = evaluate_args()
-	source_files = build_source_list(args)
-	time_script_started = datetime.now()
-	for file in source_files:
-		session = Session(file, args)
-		session.start()
-		session.job.wait()
-		session.finish()
+	metrics = Metrics(args.metrics_port, args.event_log)
+	try:
+		sessions = build_source_list(args, metrics)
+		time_script_started = datetime.now()
+		for queue_position, session in enumerate(sessions):
+			metrics.set_queue_depth(len(sessions) - queue_position - 1)
+			try:
+				transcode(session, metrics)
+			except SystemExit as error:
+				# Session.signal_handler() exits mid-job, record the failure before leaving
+				metrics.job_failed(session.path["source"], str(error.code).strip())
+				raise
+			except Exception as error:
+				print("\n{date}: Failed to transcode {source}: {error}\n".format(date=str(datetime.now()), source=session.path["source"], error=repr(error)))
+				metrics.job_failed(session.path["source"], repr(error))
+
+		metrics.set_queue_depth(0)
+	finally:
+		metrics.close()
 
 	time_script_finished = datetime.now()
 	time_script_duration = time_script_finished - time_script_started